@@ -1,14 +1,20 @@
 #!/usr/bin/env python3
 import os
+import asyncio
 import logging
 import threading
 import sqlite3
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from collections import deque
+import time
+import functools
+import secrets
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque, OrderedDict
 from datetime import datetime
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -24,11 +30,32 @@ from telegram.ext import (
 BOT_TOKEN = os.environ.get("BOT_TOKEN") or "7995697835:AAHCYXhis8B7LzuFODcB6IvRNs51idEjWM4"
 PAYMENT_URL = os.environ.get("PAYMENT_URL", "https://example.com/payment")  # placeholder
 DB_FILE = os.environ.get("BOT_DB", "bot_data.db")
-# Host will usually expose PORT; default to 8080 for local testing
-HEALTH_PORT = int(os.environ.get("PORT", os.environ.get("HEALTH_PORT", 8080)))
+# Host will usually expose PORT; the webhook listens there (default 8080 for local testing)
+WEBHOOK_PORT = int(os.environ.get("PORT", 8080))
+# Optional separate port for the plain HTTP health check; it can't share WEBHOOK_PORT
+# (the webhook server would fail to bind), so it is only started when set to another port
+HEALTH_PORT = int(os.environ["HEALTH_PORT"]) if os.environ.get("HEALTH_PORT") else None
 # Webhook path will be /<BOT_TOKEN> by design (keeps it private)
 WEBHOOK_PATH = "/" + BOT_TOKEN
 APP_URL = os.environ.get("APP_URL")  # e.g. https://your-app.onrender.com
+# Telegram echoes this in the X-Telegram-Bot-Api-Secret-Token header; other POSTs are rejected.
+# A random one is generated per start if unset (run_webhook re-registers it with setWebhook).
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET") or secrets.token_urlsafe(32)
+# In-memory profile cache (set PROFILE_CACHE=0 to disable)
+PROFILE_CACHE = os.environ.get("PROFILE_CACHE", "1") != "0"
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", 1024))
+# Forward records are buffered and written in batches of this size, or after this many seconds
+FORWARD_BATCH_SIZE = int(os.environ.get("FORWARD_BATCH_SIZE", 50))
+FORWARD_FLUSH_INTERVAL = float(os.environ.get("FORWARD_FLUSH_INTERVAL", 0.5))
+# While writes keep failing: retry delay doubles up to this many seconds, and at most this
+# many unwritten records are held (oldest dropped first)
+FORWARD_RETRY_MAX_DELAY = float(os.environ.get("FORWARD_RETRY_MAX_DELAY", 30))
+FORWARD_BUFFER_MAX = int(os.environ.get("FORWARD_BUFFER_MAX", 10_000))
+# Outgoing Bot API calls are throttled to Telegram's limits (30 msg/s overall, 20/min per group)
+SEND_RATE_PER_SEC = int(os.environ.get("SEND_RATE_PER_SEC", 30))
+SEND_MAX_RETRIES = int(os.environ.get("SEND_MAX_RETRIES", 3))
+# Most users whose previous partner is remembered for /previous (least recently paired dropped first)
+LAST_PARTNER_MAX = int(os.environ.get("LAST_PARTNER_MAX", 100_000))
 
 # ---------------- Health check ----------------
 class HealthCheckHandler(BaseHTTPRequestHandler):
@@ -38,8 +65,13 @@ class HealthCheckHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write(b"OK")
 
+    def log_message(self, format, *args):
+        # probes arrive every few seconds; don't write an access-log line to stderr for each
+        pass
+
 def start_health_server(port=HEALTH_PORT):
-    server = HTTPServer(("0.0.0.0", port), HealthCheckHandler)
+    # one thread per request so a slow probe can't hold up the next one
+    server = ThreadingHTTPServer(("0.0.0.0", port), HealthCheckHandler)
     server.serve_forever()
 
 # ---------------- Logging ----------------
@@ -49,17 +81,158 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ---------------- In-memory structures ----------------
-waiting = deque()   # queue of user ids waiting
-partners = {}       # partners[user_id] = partner_id
-last_partner = {}   # last_partner[user_id] = last_partner_id
+class MatchmakingState:
+    """Waiting queue and active/previous pairings; all chat state lives here."""
+
+    def __init__(self):
+        self.waiting = deque()     # queue of user ids waiting (may hold stale ids, see pop_waiting)
+        self.waiting_set = set()   # user ids currently waiting; the source of truth for membership
+        self.partners = {}         # partners[user_id] = partner_id
+        self.last_partner = OrderedDict()   # last_partner[user_id] = last_partner_id, LRU-capped
+        # held by /chat and /exit while they update the structures above together
+        self.lock = asyncio.Lock()
+
+    def is_waiting(self, user_id):
+        return user_id in self.waiting_set
+
+    def partner_of(self, user_id):
+        return self.partners.get(user_id)
+
+    def previous_partner_of(self, user_id):
+        return self.last_partner.get(user_id)
+
+    def enqueue(self, user_id):
+        self.waiting.append(user_id)
+        self.waiting_set.add(user_id)
+
+    def leave_queue(self, user_id):
+        # the deque entry stays behind and is skipped by pop_waiting
+        if user_id not in self.waiting_set:
+            return False
+        self.waiting_set.discard(user_id)
+        return True
+
+    def pop_waiting(self):
+        while self.waiting:
+            uid = self.waiting.popleft()
+            if uid in self.waiting_set:
+                self.waiting_set.discard(uid)
+                return uid
+        return None
+
+    def pair(self, user_id, partner_id):
+        self.partners[user_id] = partner_id
+        self.partners[partner_id] = user_id
+        self._remember_partner(user_id, partner_id)
+        self._remember_partner(partner_id, user_id)
+
+    def unpair(self, user_id):
+        # returns the former partner, or None if the user was not in a chat
+        partner_id = self.partners.pop(user_id, None)
+        if partner_id is None:
+            return None
+        self.partners.pop(partner_id, None)
+        self._remember_partner(user_id, partner_id)
+        return partner_id
+
+    def _remember_partner(self, user_id, partner_id):
+        self.last_partner[user_id] = partner_id
+        self.last_partner.move_to_end(user_id)
+        if len(self.last_partner) > LAST_PARTNER_MAX:
+            self.last_partner.popitem(last=False)
+
+state = MatchmakingState()
 
 # ---------------- SQLite helpers ----------------
+# One long-lived connection shared by all helpers (opened in init_db).
+# Reusing it keeps SQLite's page cache warm instead of paying connect/close per call.
+# The helpers are blocking: async handlers must call them through run_db(), whose single
+# worker runs them in submission order. _db_lock still guards the connection for callers
+# outside the executor (init_db runs on the main thread).
 _db_lock = threading.Lock()
+_conn = None
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+
+# Applied to every new connection (all are per-connection except journal_mode,
+# which is persisted in the database file). All access goes through one connection
+# under _db_lock, so WAL buys cheaper commits here: appends to the log, and with
+# synchronous=NORMAL no fsync per commit, only at checkpoints. The busy timeout is
+# sqlite3.connect's default timeout=5.0.
+_DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA mmap_size=134217728",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Hot-path statements, one definition each. sqlite3 caches prepared statements per
+# connection (keyed by SQL text), so on the long-lived connection each is prepared once.
+_SQL_SELECT_PROFILE_ID = "SELECT user_id FROM profiles WHERE user_id=?"
+_SQL_UPDATE_PROFILE_AGE = "UPDATE profiles SET age=?, updated_at=? WHERE user_id=?"
+_SQL_UPDATE_PROFILE_GENDER = "UPDATE profiles SET gender=?, updated_at=? WHERE user_id=?"
+_SQL_UPDATE_PROFILE_PREMIUM = "UPDATE profiles SET is_premium=?, updated_at=? WHERE user_id=?"
+_SQL_INSERT_PROFILE = "INSERT INTO profiles(user_id, age, gender, is_premium, updated_at) VALUES(?,?,?,?,?)"
+_SQL_SELECT_PROFILE = "SELECT age, gender, is_premium, updated_at FROM profiles WHERE user_id=?"
+_SQL_INSERT_REPORT = "INSERT INTO reports(reporter_id, partner_id, reason, ts) VALUES(?,?,?,?)"
+_SQL_INSERT_FORWARD = "INSERT INTO forwards(user_id, partner_id, orig_msg_id, fwd_msg_id, content_type, ts) VALUES(?,?,?,?,?,?)"
+_SQL_SELECT_LAST_FORWARD = "SELECT id, fwd_msg_id, partner_id FROM forwards WHERE user_id=? ORDER BY id DESC LIMIT 1"
+_SQL_DELETE_FORWARD = "DELETE FROM forwards WHERE id=?"
+_SQL_SELECT_PREMIUM_IDS = "SELECT user_id FROM profiles WHERE is_premium=1"
+
+def _connect():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    for pragma in _DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+async def run_db(func, *args, **kwargs):
+    # run a blocking DB helper on the DB thread pool so it never stalls the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_db_executor, functools.partial(func, *args, **kwargs))
+
+# timestamp column of each table; databases created before timestamps became
+# unix seconds declare these as TEXT
+_TS_COLUMNS = {"profiles": "updated_at", "reports": "ts", "forwards": "ts"}
+
+def _rename_legacy_ts_tables(cur):
+    # a TEXT column keeps TEXT affinity, so SQLite would store new int timestamps as
+    # text; move such tables aside so init_db can recreate them with INTEGER columns
+    legacy = []
+    for table, column in _TS_COLUMNS.items():
+        cols = cur.execute(f"PRAGMA table_info({table})").fetchall()
+        if any(col[1] == column and col[2].upper() == "TEXT" for col in cols):
+            cur.execute(f"ALTER TABLE {table} RENAME TO {table}_legacy")
+            legacy.append(table)
+    return legacy
+
+def _copy_legacy_ts_tables(cur, legacy):
+    # ISO strings become unix seconds; values strftime can't parse are kept as they are
+    for table in legacy:
+        column = _TS_COLUMNS[table]
+        names = [col[1] for col in cur.execute(f"PRAGMA table_info({table}_legacy)").fetchall()]
+        select = ", ".join(
+            f"COALESCE(CAST(strftime('%s', {name}) AS INTEGER), {name})" if name == column else name
+            for name in names
+        )
+        cur.execute(f"INSERT INTO {table}({', '.join(names)}) SELECT {select} FROM {table}_legacy")
+        # carry over the AUTOINCREMENT high-water mark so ids of deleted rows are never reused
+        # (RENAME moved the sqlite_sequence row to the legacy name; the copy only sets it to max(id))
+        seq = cur.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (f"{table}_legacy",)).fetchone()
+        if seq is not None:
+            cur.execute("DELETE FROM sqlite_sequence WHERE name=?", (table,))
+            cur.execute("INSERT INTO sqlite_sequence(name, seq) VALUES(?, ?)", (table, seq[0]))
+        cur.execute(f"DROP TABLE {table}_legacy")
+        logger.info("Migrated %s.%s to integer timestamps", table, column)
 
 def init_db():
+    global _conn
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cur = conn.cursor()
+        _conn = _connect()
+        cur = _conn.cursor()
+        # schema changes and the data copy happen in one transaction
+        cur.execute("BEGIN")
+        legacy = _rename_legacy_ts_tables(cur)
         # user profiles
         cur.execute("""
             CREATE TABLE IF NOT EXISTS profiles (
@@ -67,7 +240,7 @@ def init_db():
                 age INTEGER,
                 gender TEXT,
                 is_premium INTEGER DEFAULT 0,
-                updated_at TEXT
+                updated_at INTEGER
             )
         """)
         # reports
@@ -77,7 +250,7 @@ def init_db():
                 reporter_id INTEGER,
                 partner_id INTEGER,
                 reason TEXT,
-                ts TEXT
+                ts INTEGER
             )
         """)
         # forwards mapping for delete feature
@@ -89,105 +262,264 @@ def init_db():
                 orig_msg_id INTEGER,
                 fwd_msg_id INTEGER,
                 content_type TEXT,
-                ts TEXT
+                ts INTEGER
             )
         """)
-        conn.commit()
-        conn.close()
+        # must run before the index is created: the legacy forwards table may own idx_forwards_user
+        _copy_legacy_ts_tables(cur, legacy)
+        # db_get_last_forward looks up the newest row per user
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_forwards_user ON forwards(user_id, id DESC)")
+        cur.execute("COMMIT")
+        _premium.clear()
+        _premium.update(row[0] for row in cur.execute(_SQL_SELECT_PREMIUM_IDS))
+
+# profiles are read far more often than written: keep recent rows in an LRU,
+# invalidated by db_set_profile
+_profile_cache = OrderedDict()   # _profile_cache[user_id] = profile dict
+_profile_cache_lock = threading.Lock()
+# ids of premium users, loaded by init_db and kept in sync by db_set_profile
+_premium = set()
+
+def close_db():
+    global _conn
+    with _db_lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
 
 def db_set_profile(user_id: int, age=None, gender=None, is_premium=None):
-    ts = datetime.utcnow().isoformat()
+    ts = int(time.time())
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cur = conn.cursor()
-        cur.execute("SELECT user_id FROM profiles WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        if row:
-            # update fields provided
-            if age is not None:
-                cur.execute("UPDATE profiles SET age=?, updated_at=? WHERE user_id=?", (age, ts, user_id))
-            if gender is not None:
-                cur.execute("UPDATE profiles SET gender=?, updated_at=? WHERE user_id=?", (gender, ts, user_id))
-            if is_premium is not None:
-                cur.execute("UPDATE profiles SET is_premium=?, updated_at=? WHERE user_id=?", (int(bool(is_premium)), ts, user_id))
-        else:
-            cur.execute("INSERT INTO profiles(user_id, age, gender, is_premium, updated_at) VALUES(?,?,?,?,?)",
-                        (user_id, age, gender, int(bool(is_premium)) if is_premium is not None else 0, ts))
-        conn.commit()
-        conn.close()
+        # autocommit connection: group the read + updates in one transaction
+        _conn.execute("BEGIN")
+        try:
+            row = _conn.execute(_SQL_SELECT_PROFILE_ID, (user_id,)).fetchone()
+            if row:
+                # update fields provided
+                if age is not None:
+                    _conn.execute(_SQL_UPDATE_PROFILE_AGE, (age, ts, user_id))
+                if gender is not None:
+                    _conn.execute(_SQL_UPDATE_PROFILE_GENDER, (gender, ts, user_id))
+                if is_premium is not None:
+                    _conn.execute(_SQL_UPDATE_PROFILE_PREMIUM, (int(bool(is_premium)), ts, user_id))
+            else:
+                _conn.execute(_SQL_INSERT_PROFILE,
+                              (user_id, age, gender, int(bool(is_premium)) if is_premium is not None else 0, ts))
+        except Exception:
+            _conn.execute("ROLLBACK")
+            raise
+        _conn.execute("COMMIT")
+        if is_premium:
+            _premium.add(user_id)
+        elif is_premium is not None:
+            _premium.discard(user_id)
+        # invalidate before releasing _db_lock: a reader can only refill the cache under
+        # _db_lock, so it either sees this commit or is done before the pop
+        with _profile_cache_lock:
+            _profile_cache.pop(user_id, None)
+
+def _select_profile(user_id: int):
+    # caller holds _db_lock
+    row = _conn.execute(_SQL_SELECT_PROFILE, (user_id,)).fetchone()
+    if row:
+        return {"age": row[0], "gender": row[1], "is_premium": bool(row[2]), "updated_at": row[3]}
+    return {"age": None, "gender": None, "is_premium": False, "updated_at": None}
 
 def db_get_profile(user_id: int):
+    if not PROFILE_CACHE:
+        with _db_lock:
+            return _select_profile(user_id)
+    with _profile_cache_lock:
+        profile = _profile_cache.get(user_id)
+        if profile is not None:
+            _profile_cache.move_to_end(user_id)
+            return dict(profile)
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cur = conn.cursor()
-        cur.execute("SELECT age, gender, is_premium, updated_at FROM profiles WHERE user_id=?", (user_id,))
-        row = cur.fetchone()
-        conn.close()
-        if row:
-            return {"age": row[0], "gender": row[1], "is_premium": bool(row[2]), "updated_at": row[3]}
-        return {"age": None, "gender": None, "is_premium": False, "updated_at": None}
+        profile = _select_profile(user_id)
+        # fill while still holding _db_lock so a concurrent db_set_profile can't
+        # invalidate first and leave this (then stale) row cached
+        with _profile_cache_lock:
+            _profile_cache[user_id] = profile
+            _profile_cache.move_to_end(user_id)
+            if len(_profile_cache) > PROFILE_CACHE_SIZE:
+                _profile_cache.popitem(last=False)
+    return dict(profile)
 
 def db_add_report(reporter_id: int, partner_id: int, reason: str = ""):
-    ts = datetime.utcnow().isoformat()
+    ts = int(time.time())
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cur = conn.cursor()
-        cur.execute("INSERT INTO reports(reporter_id, partner_id, reason, ts) VALUES(?,?,?,?)",
-                    (reporter_id, partner_id, reason, ts))
-        conn.commit()
-        conn.close()
-
-def db_add_forward(user_id:int, partner_id:int, orig_msg_id:int, fwd_msg_id:int, content_type:str):
-    ts = datetime.utcnow().isoformat()
+        _conn.execute(_SQL_INSERT_REPORT, (reporter_id, partner_id, reason, ts))
+
+def db_add_forwards(rows):
+    # rows: iterable of (user_id, partner_id, orig_msg_id, fwd_msg_id, content_type, ts)
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cur = conn.cursor()
-        cur.execute("INSERT INTO forwards(user_id, partner_id, orig_msg_id, fwd_msg_id, content_type, ts) VALUES(?,?,?,?,?,?)",
-                    (user_id, partner_id, orig_msg_id, fwd_msg_id, content_type, ts))
-        conn.commit()
-        conn.close()
+        _conn.execute("BEGIN")
+        try:
+            _conn.executemany(_SQL_INSERT_FORWARD, rows)
+        except Exception:
+            _conn.execute("ROLLBACK")
+            raise
+        _conn.execute("COMMIT")
 
 def db_get_last_forward(user_id:int):
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cur = conn.cursor()
-        cur.execute("SELECT id, fwd_msg_id, partner_id FROM forwards WHERE user_id=? ORDER BY id DESC LIMIT 1", (user_id,))
-        row = cur.fetchone()
-        conn.close()
-        return row  # None or (id, fwd_msg_id, partner_id)
+        row = _conn.execute(_SQL_SELECT_LAST_FORWARD, (user_id,)).fetchone()
+    return row  # None or (id, fwd_msg_id, partner_id)
 
 def db_delete_forward_record(record_id:int):
     with _db_lock:
-        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
-        cur = conn.cursor()
-        cur.execute("DELETE FROM forwards WHERE id=?", (record_id,))
-        conn.commit()
-        conn.close()
+        _conn.execute(_SQL_DELETE_FORWARD, (record_id,))
+
+# ---------------- Forward record batching ----------------
+# forward_messages only appends to this buffer; a background task writes it out
+# in one transaction per batch instead of one commit per forwarded message.
+_forward_buffer = []
+_forward_wakeup = None   # asyncio.Event, set when a full batch is waiting
+_forward_task = None
+_forward_flush_lock = asyncio.Lock()   # one batch in flight at a time
+_forward_dropped = 0   # records dropped by _trim_forward_buffer, reported by the flusher
+
+def queue_forward(user_id:int, partner_id:int, orig_msg_id:int, fwd_msg_id:int, content_type:str):
+    ts = int(time.time())
+    _forward_buffer.append((user_id, partner_id, orig_msg_id, fwd_msg_id, content_type, ts))
+    if len(_forward_buffer) > FORWARD_BUFFER_MAX:
+        _trim_forward_buffer()
+    elif len(_forward_buffer) >= FORWARD_BATCH_SIZE and _forward_wakeup is not None:
+        _forward_wakeup.set()
+
+def _trim_forward_buffer():
+    # only reached while writes are failing; the oldest records matter least to /delete_last
+    global _forward_dropped
+    overflow = len(_forward_buffer) - FORWARD_BUFFER_MAX
+    if overflow > 0:
+        del _forward_buffer[:overflow]
+        _forward_dropped += overflow
+
+async def flush_forwards():
+    # write out everything buffered so far (also used before reading forwards back);
+    # holding the lock means a batch already being written is finished on return
+    global _forward_buffer
+    async with _forward_flush_lock:
+        if not _forward_buffer:
+            return
+        rows, _forward_buffer = _forward_buffer, []
+        try:
+            await run_db(db_add_forwards, rows)
+        except Exception:
+            # the batch was rolled back: put it back in front of anything queued meanwhile
+            # so the next flush retries it in order
+            _forward_buffer = rows + _forward_buffer
+            _trim_forward_buffer()
+            raise
+
+async def _forward_flusher():
+    global _forward_dropped
+    failures = 0
+    delay = FORWARD_FLUSH_INTERVAL
+    while True:
+        if failures:
+            # back off while the DB is failing; full-batch wakeups are ignored meanwhile
+            await asyncio.sleep(delay)
+        else:
+            try:
+                await asyncio.wait_for(_forward_wakeup.wait(), timeout=FORWARD_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        _forward_wakeup.clear()
+        try:
+            await flush_forwards()
+        except Exception as e:
+            failures += 1
+            delay = min(delay * 2, FORWARD_RETRY_MAX_DELAY)
+            if failures == 1:
+                logger.exception("Flushing forward records failed: %s", e)
+            else:
+                logger.warning("Flushing forward records still failing (%d attempts, %d records held), "
+                               "retrying in %.1fs: %s", failures, len(_forward_buffer), delay, e)
+        else:
+            if failures:
+                logger.info("Flushing forward records recovered after %d failed attempts", failures)
+            failures = 0
+            delay = FORWARD_FLUSH_INTERVAL
+        if _forward_dropped:
+            logger.warning("Forward buffer full (%d records), dropped %d oldest unwritten records",
+                           FORWARD_BUFFER_MAX, _forward_dropped)
+            _forward_dropped = 0
+
+async def post_init(app: Application):
+    global _forward_wakeup, _forward_task
+    _forward_wakeup = asyncio.Event()
+    _forward_task = asyncio.create_task(_forward_flusher())
+
+async def post_shutdown(app: Application):
+    if _forward_task is not None:
+        _forward_task.cancel()
+        try:
+            await _forward_task
+        except asyncio.CancelledError:
+            pass
+    try:
+        await flush_forwards()
+    except Exception as e:
+        logger.exception("Final flush failed, %d forward records dropped: %s", len(_forward_buffer), e)
+    finally:
+        await run_db(close_db)
+        _db_executor.shutdown(wait=True)
 
 # ---------------- Utility ----------------
+def format_ts(ts):
+    # timestamps are stored as unix seconds; an old value init_db could not convert is returned as-is
+    if isinstance(ts, str) and ts.isdigit():
+        ts = int(ts)
+    if isinstance(ts, int):
+        return datetime.utcfromtimestamp(ts).isoformat()
+    return ts
+
 def is_premium_user(user_id:int):
-    profile = db_get_profile(user_id)
-    return profile.get("is_premium", False)
+    return user_id in _premium
+
+# ---------------- Static replies ----------------
+# built once at import; the markup and texts never change between calls
+START_TEXT = "👋 Welcome! Choose an option:"
+START_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💬 Chat", callback_data="chat"),
+     InlineKeyboardButton("❌ Leave chat", callback_data="leave")],
+    [InlineKeyboardButton("⚠ Report", callback_data="report"),
+     InlineKeyboardButton("🔎 Search by gender", callback_data="search_gender")],
+    [InlineKeyboardButton("⚙ Settings", callback_data="settings"),
+     InlineKeyboardButton("❓ Help", callback_data="help")]
+])
+
+SETTINGS_TEXT = (
+    "⚙ Settings - quick commands:\n"
+    "/profile - show your profile\n"
+    "/set age <number> - set your age\n"
+    "/set gender <male/female/other> - set gender\n"
+    "/set premium on|off - toggle premium (admin only in real world)\n"
+)
+
+RULES_TEXT = (
+    "📜 Chat Rules:\n"
+    "a) Avoid sharing personal details\n"
+    "b) Abusing other users is not allowed\n"
+    "c) Sexual content is not allowed\n"
+    "d) Sending links is not allowed\n"
+    "e) Sending spam/fraud messages are not allowed"
+)
+
+HELP_TEXT = "❓ Help section: For now, commands: /start /chat /exit /profile /set /delete_last /rules /report"
+HELP_CMD_TEXT = "❓ Help coming soon!"
 
 # ---------------- Commands & Handlers ----------------
 
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # show the 6-button inline keyboard
-    keyboard = [
-        [InlineKeyboardButton("💬 Chat", callback_data="chat"),
-         InlineKeyboardButton("❌ Leave chat", callback_data="leave")],
-        [InlineKeyboardButton("⚠ Report", callback_data="report"),
-         InlineKeyboardButton("🔎 Search by gender", callback_data="search_gender")],
-        [InlineKeyboardButton("⚙ Settings", callback_data="settings"),
-         InlineKeyboardButton("❓ Help", callback_data="help")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
     # prefer reply_text if message exists
     if update.message:
-        await update.message.reply_text("👋 Welcome! Choose an option:", reply_markup=reply_markup)
+        await update.message.reply_text(START_TEXT, reply_markup=START_KEYBOARD)
     else:
         # fallback
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="👋 Welcome! Choose an option:", reply_markup=reply_markup)
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=START_TEXT, reply_markup=START_KEYBOARD)
 
 async def chat_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.id
@@ -196,140 +528,166 @@ async def chat_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Please use this bot in private chat (one-to-one).")
         return
 
-    if user in partners:
-        await update.message.reply_text("⚠ You are already in a chat. Use /exit to leave.")
-        return
-    if user in waiting:
-        await update.message.reply_text("⏳ You are already waiting...")
-        return
-
-    # try to find compatible waiting partner (basic FIFO)
-    # (premium gender search not applied here)
-    if waiting:
-        partner = waiting.popleft()
-        if partner == user:
-            waiting.appendleft(partner)
-            await update.message.reply_text("⏳ Waiting for a partner...")
-            return
-        partners[user] = partner
-        partners[partner] = user
-        last_partner[user] = partner
-        last_partner[partner] = user
-        await context.bot.send_message(chat_id=user, text="✅ Partner found! Say hi 👋")
-        await context.bot.send_message(chat_id=partner, text="✅ Partner found! Say hi 👋")
+    # decide under the lock, send outside it so a slow API call never blocks other /chat or /exit
+    partner = None
+    async with state.lock:
+        if state.partner_of(user) is not None:
+            reply = "⚠ You are already in a chat. Use /exit to leave."
+        elif state.is_waiting(user):
+            reply = "⏳ You are already waiting..."
+        else:
+            # try to find compatible waiting partner (basic FIFO)
+            # (premium gender search not applied here)
+            partner = state.pop_waiting()
+            if partner is not None:
+                state.pair(user, partner)
+            else:
+                state.enqueue(user)
+                reply = "⏳ Waiting for a partner..."
+
+    if partner is not None:
+        # notify both sides concurrently; one failing must not stop the other
+        results = await asyncio.gather(
+            context.bot.send_message(chat_id=user, text="✅ Partner found! Say hi 👋"),
+            context.bot.send_message(chat_id=partner, text="✅ Partner found! Say hi 👋"),
+            return_exceptions=True,
+        )
+        for chat_id, result in zip((user, partner), results):
+            if isinstance(result, Exception):
+                logger.warning("Partner-found notice to %s failed: %s", chat_id, result)
     else:
-        waiting.append(user)
-        await update.message.reply_text("⏳ Waiting for a partner...")
+        await update.message.reply_text(reply)
 
 async def exit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.id
-    if user in waiting:
-        try:
-            waiting.remove(user)
-        except ValueError:
-            pass
-        await update.message.reply_text("⛔ You left the queue.")
-        return
-    if user in partners:
-        partner = partners.get(user)
-        # cleanup
-        try:
-            del partners[partner]
-        except KeyError:
-            pass
-        try:
-            del partners[user]
-        except KeyError:
-            pass
-        last_partner[user] = partner
-        if partner:
-            try:
-                await context.bot.send_message(chat_id=partner, text="⚠ Your partner left the chat.")
-            except Exception:
-                pass
-        await update.message.reply_text("❌ You left the chat.")
+    partner = None
+    async with state.lock:
+        if state.leave_queue(user):
+            reply = "⛔ You left the queue."
+        else:
+            partner = state.unpair(user)
+            reply = "❌ You left the chat." if partner is not None else "You are not in a chat or queue."
+
+    if partner:
+        # the partner notice is best-effort; send it alongside the user's own reply
+        results = await asyncio.gather(
+            context.bot.send_message(chat_id=partner, text="⚠ Your partner left the chat."),
+            update.message.reply_text(reply),
+            return_exceptions=True,
+        )
+        if isinstance(results[0], Exception):
+            logger.warning("Partner-left notice to %s failed: %s", partner, results[0])
+        if isinstance(results[1], Exception):
+            raise results[1]
         return
-    await update.message.reply_text("You are not in a chat or queue.")
+    await update.message.reply_text(reply)
 
 async def forward_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # handle text, photo, sticker forwarding; store mapping for delete
     user = update.effective_user.id
-    if user not in partners:
-        return
-    partner = partners.get(user)
+    partner = state.partner_of(user)
     if not partner:
         return
 
     try:
         if update.message.text:
             sent = await context.bot.send_message(chat_id=partner, text=update.message.text)
-            db_add_forward(user, partner, update.message.message_id, sent.message_id, "text")
+            queue_forward(user, partner, update.message.message_id, sent.message_id, "text")
         elif update.message.photo:
             file_id = update.message.photo[-1].file_id
             sent = await context.bot.send_photo(chat_id=partner, photo=file_id, caption=update.message.caption)
-            db_add_forward(user, partner, update.message.message_id, sent.message_id, "photo")
+            queue_forward(user, partner, update.message.message_id, sent.message_id, "photo")
         elif update.message.sticker:
             # using Sticker.ALL in filters, but retrieve sticker file id here
             sent = await context.bot.send_sticker(chat_id=partner, sticker=update.message.sticker.file_id)
-            db_add_forward(user, partner, update.message.message_id, sent.message_id, "sticker")
+            queue_forward(user, partner, update.message.message_id, sent.message_id, "sticker")
         else:
             sent = await context.bot.send_message(chat_id=partner, text="📨 (Message forwarded)")
-            db_add_forward(user, partner, update.message.message_id, sent.message_id, "other")
+            queue_forward(user, partner, update.message.message_id, sent.message_id, "other")
     except Exception as e:
         logger.exception("Forwarding failed: %s", e)
 
 # ---------------- Callback (inline buttons) ----------------
-async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
+async def _cb_chat(query, context, user):
+    # start pairing flow
+    await query.edit_message_text("🔍 Searching for a partner... Please run /chat to start pairing in private chat.")
 
-    user = query.from_user.id
+async def _cb_leave(query, context, user):
+    await query.edit_message_text("❌ Use /exit in private chat to leave chat or queue.")
 
-    if query.data == "chat":
-        # start pairing flow
-        await query.edit_message_text("🔍 Searching for a partner... Please run /chat to start pairing in private chat.")
-        return
+async def _cb_report(query, context, user):
+    # if user in partner, report them
+    partner = state.partner_of(user)
+    if partner:
+        await run_db(db_add_report, user, partner, reason="Reported via button")
+        await query.edit_message_text("⚠ Your request to report is saved. We'll verify and take action soon. Enjoy our services.")
+    else:
+        await query.edit_message_text("⚠ You are not in an active chat to report.")
 
-    if query.data == "leave":
-        await query.edit_message_text("❌ Use /exit in private chat to leave chat or queue.")
-        return
+async def _cb_search(query, context, user):
+    await query.edit_message_text("🔎 Search by gender is a premium feature. Please purchase premium.")
 
-    if query.data == "report":
-        # if user in partner, report them
-        partner = partners.get(user)
-        if partner:
-            db_add_report(user, partner, reason="Reported via button")
-            await query.edit_message_text("⚠ Your request to report is saved. We'll verify and take action soon. Enjoy our services.")
-        else:
-            await query.edit_message_text("⚠ You are not in an active chat to report.")
-        return
+async def _cb_settings(query, context, user):
+    # show quick settings instructions
+    await query.edit_message_text(SETTINGS_TEXT)
 
-    if query.data == "search_gender":
-        await query.edit_message_text("🔎 Search by gender is a premium feature. Please purchase premium.")
-        return
+async def _cb_help(query, context, user):
+    await query.edit_message_text(HELP_TEXT)
 
-    if query.data == "settings":
-        # show quick settings instructions
-        txt = (
-            "⚙ Settings - quick commands:\n"
-            "/profile - show your profile\n"
-            "/set age <number> - set your age\n"
-            "/set gender <male/female/other> - set gender\n"
-            "/set premium on|off - toggle premium (admin only in real world)\n"
-        )
-        await query.edit_message_text(txt)
-        return
+# callback_data -> handler
+_CB_HANDLERS = {
+    "chat": _cb_chat,
+    "leave": _cb_leave,
+    "report": _cb_report,
+    "search_gender": _cb_search,
+    "settings": _cb_settings,
+    "help": _cb_help,
+}
+
+async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
 
-    if query.data == "help":
-        await query.edit_message_text("❓ Help section: For now, commands: /start /chat /exit /profile /set /delete_last /rules /report")
+    handler = _CB_HANDLERS.get(query.data)
+    if handler:
+        await handler(query, context, query.from_user.id)
 
 # ---------------- Additional commands (profile, set, report, delete) ----------------
 async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.id
-    prof = db_get_profile(user)
-    text = f"👤 Profile:\nAge: {prof.get('age')}\nGender: {prof.get('gender')}\nPremium: {prof.get('is_premium')}\nLast updated: {prof.get('updated_at')}"
+    prof = await run_db(db_get_profile, user)
+    text = f"👤 Profile:\nAge: {prof.get('age')}\nGender: {prof.get('gender')}\nPremium: {prof.get('is_premium')}\nLast updated: {format_ts(prof.get('updated_at'))}"
     await update.message.reply_text(text)
 
+async def _set_age(update: Update, user: int, value: str):
+    try:
+        age = int(value)
+    except ValueError:
+        await update.message.reply_text("Please provide a valid age number.")
+        return
+    await run_db(db_set_profile, user, age=age)
+    await update.message.reply_text(f"✅ Your age is set to {age}")
+
+async def _set_gender(update: Update, user: int, value: str):
+    gender = value.lower()
+    await run_db(db_set_profile, user, gender=gender)
+    await update.message.reply_text(f"✅ Your gender is set to {gender}")
+
+async def _set_premium(update: Update, user: int, value: str):
+    if value.lower() in ("on", "1", "true", "yes"):
+        await run_db(db_set_profile, user, is_premium=1)
+        await update.message.reply_text("✅ Premium flag set to ON (for testing).")
+    else:
+        await run_db(db_set_profile, user, is_premium=0)
+        await update.message.reply_text("✅ Premium flag set to OFF.")
+
+# /set field -> handler
+_SET_HANDLERS = {
+    "age": _set_age,
+    "gender": _set_gender,
+    "premium": _set_premium,
+}
+
 async def set_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # usage: /set field value
     user = update.effective_user.id
@@ -339,51 +697,36 @@ async def set_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     field = args[0].lower()
     value = " ".join(args[1:]).strip()
-    if field == "age":
-        try:
-            age = int(value)
-            db_set_profile(user, age=age)
-            await update.message.reply_text(f"✅ Your age is set to {age}")
-        except ValueError:
-            await update.message.reply_text("Please provide a valid age number.")
-    elif field == "gender":
-        gender = value.lower()
-        db_set_profile(user, gender=gender)
-        await update.message.reply_text(f"✅ Your gender is set to {gender}")
-    elif field == "premium":
-        if value.lower() in ("on", "1", "true", "yes"):
-            db_set_profile(user, is_premium=1)
-            await update.message.reply_text("✅ Premium flag set to ON (for testing).")
-        else:
-            db_set_profile(user, is_premium=0)
-            await update.message.reply_text("✅ Premium flag set to OFF.")
+    handler = _SET_HANDLERS.get(field)
+    if handler:
+        await handler(update, user, value)
     else:
         await update.message.reply_text("Unknown field. Allowed: age, gender, premium")
 
 async def rules_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    txt = (
-        "📜 Chat Rules:\n"
-        "a) Avoid sharing personal details\n"
-        "b) Abusing other users is not allowed\n"
-        "c) Sexual content is not allowed\n"
-        "d) Sending links is not allowed\n"
-        "e) Sending spam/fraud messages are not allowed"
-    )
-    await update.message.reply_text(txt)
+    await update.message.reply_text(RULES_TEXT)
 
 async def report_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.id
-    partner = partners.get(user)
+    partner = state.partner_of(user)
     if partner:
         reason = " ".join(context.args) if context.args else ""
-        db_add_report(user, partner, reason)
+        await run_db(db_add_report, user, partner, reason)
         await update.message.reply_text("✅ Your request to report is saved. We'll verify and take action soon. Enjoy our services.")
     else:
         await update.message.reply_text("You are not in an active chat to report.")
 
 async def delete_last_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user.id
-    row = db_get_last_forward(user)
+    # make sure recently forwarded messages are visible before looking them up;
+    # if they can't be written, an older record would be found and the wrong message deleted
+    try:
+        await flush_forwards()
+    except Exception as e:
+        logger.warning("Flushing forward records for /delete_last failed: %s", e)
+        await update.message.reply_text("Could not delete right now, please try again later.")
+        return
+    row = await run_db(db_get_last_forward, user)
     if not row:
         await update.message.reply_text("No forwarded messages found to delete.")
         return
@@ -395,10 +738,10 @@ async def delete_last_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.warning("Delete forwarded message failed: %s", e)
         await update.message.reply_text("Could not delete the forwarded message (maybe already deleted).")
         # still remove mapping
-        db_delete_forward_record(record_id)
+        await run_db(db_delete_forward_record, record_id)
         return
     # removed successfully
-    db_delete_forward_record(record_id)
+    await run_db(db_delete_forward_record, record_id)
     await update.message.reply_text("✅ Your last forwarded message has been deleted.")
 
 async def previous_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -407,7 +750,7 @@ async def previous_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not is_premium_user(user):
         await update.message.reply_text("🔄 This is a premium feature. Please purchase premium.")
         return
-    partner = last_partner.get(user)
+    partner = state.previous_partner_of(user)
     if not partner:
         await update.message.reply_text("No previous partner found.")
         return
@@ -431,11 +774,30 @@ def main():
     init_db()
 
     # start health server on separate thread (useful for some hosts / uptime checks)
-    threading.Thread(target=start_health_server, daemon=True).start()
+    if HEALTH_PORT and HEALTH_PORT != WEBHOOK_PORT:
+        threading.Thread(target=start_health_server, daemon=True).start()
+    else:
+        logger.info("Health server disabled: set HEALTH_PORT to a port other than %s to enable it", WEBHOOK_PORT)
 
     # Build application
     # Important: Application requires BOT_TOKEN to be set via environment variable for security
-    app = Application.builder().token(BOT_TOKEN).build()
+    # every bot.send_*/delete_* call goes through the rate limiter, which queues calls over the
+    # limit and retries on RetryAfter (429) instead of letting them fail
+    rate_limiter = AIORateLimiter(
+        overall_max_rate=SEND_RATE_PER_SEC,
+        overall_time_period=1,
+        max_retries=SEND_MAX_RETRIES,
+    )
+    # the bot keeps one pooled httpx client for its whole lifetime (closed by Application.shutdown);
+    # PTB's default timeouts (5s connect/read/write, 1s pool) already bound each request
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .rate_limiter(rate_limiter)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Command handlers (commands + utility)
     app.add_handler(CommandHandler("start", start_cmd))
@@ -449,16 +811,14 @@ def main():
     app.add_handler(CommandHandler("previous", previous_cmd))
     app.add_handler(CommandHandler("payment", payment_cmd))
     app.add_handler(CommandHandler("paysupport", payment_cmd))
-    app.add_handler(CommandHandler("help", lambda u,c: u.message.reply_text("❓ Help coming soon!")))
+    app.add_handler(CommandHandler("help", lambda u,c: u.message.reply_text(HELP_CMD_TEXT)))
 
     # Inline callback
     app.add_handler(CallbackQueryHandler(callback_handler))
 
-    # Forward content handlers
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, forward_messages))
-    app.add_handler(MessageHandler(filters.PHOTO, forward_messages))
+    # Forward content handler: one combined filter (text, photo, sticker) so each update is checked once
     # Sticker filter updated to v20 style
-    app.add_handler(MessageHandler(filters.Sticker.ALL, forward_messages))
+    app.add_handler(MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.PHOTO | filters.Sticker.ALL, forward_messages))
 
     # Error handler
     app.add_error_handler(error_handler)
@@ -473,14 +833,15 @@ def main():
         print("Set APP_URL=https://your-deploy-domain (must be HTTPS) and BOT_TOKEN=your_token")
         return
 
-    # run webhook: listen on 0.0.0.0:HEALTH_PORT, url_path is BOT_TOKEN string, Telegram should call APP_URL/BOT_TOKEN
+    # run webhook: listen on 0.0.0.0:WEBHOOK_PORT, url_path is BOT_TOKEN string, Telegram should call APP_URL/BOT_TOKEN
     logger.info("Starting webhook with url: %s%s", APP_URL, WEBHOOK_PATH)
     print("🤖 Bot starting webhook...")
     app.run_webhook(
         listen="0.0.0.0",
-        port=HEALTH_PORT,
+        port=WEBHOOK_PORT,
         url_path=BOT_TOKEN,                     # Telegram will POST updates to /<BOT_TOKEN>
-        webhook_url=f"{APP_URL}/{BOT_TOKEN}"   # setWebhook target
+        webhook_url=f"{APP_URL}/{BOT_TOKEN}",  # setWebhook target
+        secret_token=WEBHOOK_SECRET,            # drop requests not coming from Telegram
     )
 
 if __name__ == "__main__":